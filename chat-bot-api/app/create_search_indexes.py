@@ -0,0 +1,59 @@
+"""
+One-off step that builds the /users/search indexes on an existing users table.
+
+create_all() only creates indexes together with a brand new table, so on a
+database where users already exists run this once after deploying:
+
+    python -m app.create_search_indexes
+
+(or `docker compose exec ai-chat-service python -m app.create_search_indexes`)
+
+Indexes are built with CREATE INDEX CONCURRENTLY, so users stays writable
+while they build. A concurrent build that fails leaves an INVALID index
+behind; re-running the script drops it and builds it again.
+"""
+
+from sqlalchemy import text
+from sqlalchemy.schema import CreateIndex
+from . import models
+from .database import engine
+
+
+def index_is_valid(conn, name):
+    """True if the index exists and is usable, False if INVALID, None if missing"""
+    return conn.execute(
+        text("""
+            SELECT i.indisvalid
+            FROM pg_index i
+            JOIN pg_class c ON c.oid = i.indexrelid
+            WHERE c.relname = :name
+        """),
+        {"name": name}
+    ).scalar()
+
+
+def main():
+    with engine.connect() as conn:
+        # CONCURRENTLY cannot run inside a transaction block
+        conn = conn.execution_options(isolation_level="AUTOCOMMIT")
+        # Builds over millions of rows outlast the request-time statement_timeout
+        conn.execute(text("SET statement_timeout = 0"))
+        conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+
+        for index in models.User.__table__.indexes:
+            valid = index_is_valid(conn, index.name)
+            if valid:
+                print(f"🟢 {index.name} already exists")
+                continue
+            if valid is False:
+                print(f"🟡 {index.name} is INVALID from an earlier failed build, dropping it")
+                conn.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS "{index.name}"'))
+
+            print(f"Building {index.name}...")
+            index.dialect_options["postgresql"]["concurrently"] = True
+            conn.execute(CreateIndex(index))
+            print(f"🟢 {index.name} built")
+
+
+if __name__ == "__main__":
+    main()
@@ -10,9 +10,15 @@ DB_NAME = os.getenv("DB_NAME", "ai-chat-bot")
 DB_USER = os.getenv("DB_USER", "postgres")
 DB_PASSWORD = os.getenv("DB_PASSWORD", "4166")
 
+# Server-side cap on any single query so a slow statement can't outlive the request
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "10000"))
+
 SQLALCHEMY_DATABASE_URL = f'postgresql://{DB_USER}:{DB_PASSWORD}@{DB_HOST}/{DB_NAME}'
 
-engine=create_engine(SQLALCHEMY_DATABASE_URL)
+engine=create_engine(
+    SQLALCHEMY_DATABASE_URL,
+    connect_args={"options": f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}"}
+)
 SessionLocal=sessionmaker(autocommit=False,autoflush=False,bind=engine)
 
 def get_db():
@@ -1,32 +1,45 @@
-from fastapi import FastAPI, HTTPException,Depends,Response,status
+from fastapi import FastAPI, HTTPException,Depends,Header,Request,Response,status,Query
+from fastapi.responses import PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
 from dotenv import load_dotenv
-from anthropic import Anthropic
+from anthropic import AsyncAnthropic
 from anthropic.types import ToolParam
 from pydantic import BaseModel
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, date
 from typing import Optional, List
 import psycopg2
 from psycopg2.extras import RealDictCursor
 from psycopg2 import pool
 import uvicorn
 import traceback
+import asyncio
 import os
 import time
 from . import models
 from .database import engine,get_db,Base
+from .usage import usage_ledger
+from .profiling import ProfiledRoute, ProfilingMiddleware, instrument_engine, profile_store, span, tokens_match
+from sqlalchemy import func, case, or_, text, select, union, tuple_, cast, REAL
 from sqlalchemy.orm import Session
 from sqlalchemy.exc import IntegrityError
 from . import schemas
 
-# Create database tables
-models.Base.metadata.create_all(bind=engine)
+with engine.begin() as conn:
+    # pg_trgm backs the trigram indexes used by /users/search
+    conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+
+    # Create database tables. Indexes are only created along with a new table;
+    # on an existing users table build the search indexes once, without
+    # blocking writes, with `python -m app.create_search_indexes`
+    models.Base.metadata.create_all(bind=conn)
 
 from contextlib import contextmanager
 
 load_dotenv()
 
 app = FastAPI()
+# Lets the profiler sample a sync endpoint's worker thread (see profiling.py)
+app.router.route_class = ProfiledRoute
 
 # Add CORS middleware
 app.add_middleware(
@@ -37,6 +50,10 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Opt-in per-request profiling (X-Profile header or PROFILE_SAMPLE_RATE)
+app.add_middleware(ProfilingMiddleware)
+instrument_engine(engine)
+
 class User(BaseModel):
     username: str
     email: str
@@ -103,13 +120,88 @@ def get_db_cursor():
 api_key = os.getenv("ANTHROPIC_API_KEY")
 if not api_key:
     raise ValueError("ANTHROPIC_API_KEY environment variable is required")
-client = Anthropic(api_key=api_key)
+client = AsyncAnthropic(api_key=api_key)
 
 # Use latest model for better performance
 model = "claude-3-haiku-20240307"  # Using a stable model
 
 class ChatRequest(BaseModel):
     message: str
+    # Optional so existing clients keep working; usage is then recorded without a user
+    user_id: Optional[int] = None
+
+# Upper bound on how long a single /chat request may run end to end.
+# Clients can ask for a shorter budget with the X-Request-Timeout header (seconds).
+CHAT_TIMEOUT_SECONDS = float(os.getenv("CHAT_TIMEOUT_SECONDS", "60"))
+
+class ChatDeadlineExceeded(Exception):
+    """Raised when a chat request runs out of its deadline budget"""
+    def __init__(self, partial_text=""):
+        super().__init__("Chat request deadline exceeded")
+        self.partial_text = partial_text
+
+class RequestBudget:
+    """Deadline budget for one request, plus accounting of upstream work done under it"""
+    def __init__(self, timeout):
+        self.started = time.monotonic()
+        self.deadline = self.started + timeout
+        self.upstream_calls = 0
+        self.cancelled_calls = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.cache_creation_input_tokens = 0
+        self.cache_read_input_tokens = 0
+        self.tool_iterations = 0
+
+    def remaining(self):
+        return max(0.0, self.deadline - time.monotonic())
+
+    def check(self):
+        if self.remaining() <= 0:
+            raise ChatDeadlineExceeded()
+
+    def record_usage(self, usage):
+        if usage:
+            self.input_tokens += usage.input_tokens
+            self.output_tokens += usage.output_tokens
+            # anthropic==0.40.0's Usage type doesn't declare the cache fields; they
+            # are only present when the API response includes them
+            self.cache_creation_input_tokens += getattr(usage, "cache_creation_input_tokens", 0) or 0
+            self.cache_read_input_tokens += getattr(usage, "cache_read_input_tokens", 0) or 0
+
+    def elapsed_ms(self):
+        return round((time.monotonic() - self.started) * 1000)
+
+    def report(self):
+        return {
+            "upstream_calls": self.upstream_calls,
+            "cancelled_calls": self.cancelled_calls,
+            "input_tokens": self.input_tokens,
+            "output_tokens": self.output_tokens,
+            "cache_creation_input_tokens": self.cache_creation_input_tokens,
+            "cache_read_input_tokens": self.cache_read_input_tokens,
+            "tool_iterations": self.tool_iterations,
+            "elapsed_ms": self.elapsed_ms(),
+        }
+
+def get_request_timeout(request: Request):
+    """Read the client's requested timeout, capped at CHAT_TIMEOUT_SECONDS"""
+    header = request.headers.get("x-request-timeout")
+    if not header:
+        return CHAT_TIMEOUT_SECONDS
+    try:
+        requested = float(header)
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="X-Request-Timeout must be a number of seconds"
+        )
+    if requested <= 0:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="X-Request-Timeout must be positive"
+        )
+    return min(requested, CHAT_TIMEOUT_SECONDS)
 
 class User(BaseModel):
     id: int
@@ -194,7 +286,39 @@ def process_tool_call(tool_name, tool_input):
     else:
         return f"Unknown tool: {tool_name}"
 
-def chat(messages, system=None, temperature=0, stop_sequences=None):
+def extract_text(content):
+    """Concatenate the text blocks of a message content list"""
+    text = ""
+    for block in content:
+        if hasattr(block, 'text'):
+            text += block.text
+    return text
+
+async def create_message(params, budget=None):
+    """Call the Messages API, bounded by the remaining request budget"""
+    if budget is None:
+        with span("upstream_call"):
+            return await client.messages.create(**params)
+
+    budget.check()
+    budget.upstream_calls += 1
+    try:
+        with span("upstream_call"):
+            message = await asyncio.wait_for(
+                client.messages.create(**params),
+                timeout=budget.remaining()
+            )
+    except asyncio.TimeoutError:
+        budget.cancelled_calls += 1
+        raise ChatDeadlineExceeded()
+    except asyncio.CancelledError:
+        # Client went away while the call was in flight
+        budget.cancelled_calls += 1
+        raise
+    budget.record_usage(message.usage)
+    return message
+
+async def chat(messages, system=None, temperature=0, stop_sequences=None, budget=None):
     if stop_sequences is None:
         stop_sequences = []
 
@@ -209,10 +333,13 @@ def chat(messages, system=None, temperature=0, stop_sequences=None):
     if system:
         params["system"] = system
 
-    message = client.messages.create(**params)
+    message = await create_message(params, budget)
 
     # Handle tool use loop
     while message.stop_reason == "tool_use":
+        if budget:
+            budget.tool_iterations += 1
+
         # Add assistant message with tool use
         add_assistant_message(messages, message.content)
 
@@ -220,7 +347,8 @@ def chat(messages, system=None, temperature=0, stop_sequences=None):
         tool_results = []
         for content_block in message.content:
             if content_block.type == "tool_use":
-                tool_result = process_tool_call(content_block.name, content_block.input)
+                with span("tool_execution"):
+                    tool_result = process_tool_call(content_block.name, content_block.input)
                 tool_results.append({
                     "type": "tool_result",
                     "tool_use_id": content_block.id,
@@ -232,7 +360,12 @@ def chat(messages, system=None, temperature=0, stop_sequences=None):
 
         # Continue conversation
         params["messages"] = messages
-        message = client.messages.create(**params)
+        try:
+            message = await create_message(params, budget)
+        except ChatDeadlineExceeded as e:
+            # Surface whatever the model said before running out of time
+            e.partial_text = extract_text(message.content)
+            raise
 
     return message.content
 
@@ -242,12 +375,15 @@ conversation_store = {}
 
 @app.on_event("startup")
 async def startup_event():
-    """Initialize database connection pool on startup"""
+    """Initialize database connection pool and usage ledger on startup"""
     init_db_pool()
+    usage_ledger.start()
 
 @app.on_event("shutdown")
 async def shutdown_event():
-    """Close database connection pool on shutdown"""
+    """Flush the usage ledger and close database connection pool on shutdown"""
+    await usage_ledger.stop()
+    print(f"🔴 Usage ledger flushed: {usage_ledger.stats()}")
     global db_pool
     if db_pool:
         db_pool.closeall()
@@ -257,35 +393,103 @@ async def shutdown_event():
 async def root():
     return {"message": "FastAPI server is running!"}
 
+def record_chat_usage(user_id, outcome, budget):
+    """Queue a usage ledger entry; written to the database in the background"""
+    usage_ledger.record(
+        user_id=user_id,
+        model=model,
+        status=outcome,
+        input_tokens=budget.input_tokens,
+        output_tokens=budget.output_tokens,
+        cache_creation_input_tokens=budget.cache_creation_input_tokens,
+        cache_read_input_tokens=budget.cache_read_input_tokens,
+        upstream_calls=budget.upstream_calls,
+        tool_iterations=budget.tool_iterations,
+        latency_ms=budget.elapsed_ms()
+    )
+
+async def wait_for_disconnect(request: Request, interval=0.25):
+    """Return once the client has closed the connection"""
+    while not await request.is_disconnected():
+        await asyncio.sleep(interval)
+
 @app.post("/chat")
-async def chatting(chat_request: ChatRequest):
+async def chatting(chat_request: ChatRequest, request: Request):
     system_prompt = """
     You are an expert mathematician and helpful assistant.
     """
+    budget = RequestBudget(get_request_timeout(request))
+    chat_task = None
+    disconnect_task = None
+    outcome = "error"
     try:
         # For this simple version, use a global messages list
         # In production, use session IDs
         if "default" not in conversation_store:
             conversation_store["default"] = []
         
-        messages = conversation_store["default"]
+        # Work on a copy so an abandoned request leaves history untouched
+        history = conversation_store["default"]
+        messages = list(history)
+        new_turns_start = len(messages)
         
         user_input = chat_request.message
         add_user_message(messages, user_input)
-        response = chat(messages, system=system_prompt, temperature=0, stop_sequences=[])
+
+        # Run the tool loop alongside a disconnect watcher and cancel
+        # in-flight upstream work as soon as the client goes away
+        chat_task = asyncio.create_task(
+            chat(messages, system=system_prompt, temperature=0, stop_sequences=[], budget=budget)
+        )
+        disconnect_task = asyncio.create_task(wait_for_disconnect(request))
+        await asyncio.wait({chat_task, disconnect_task}, return_when=asyncio.FIRST_COMPLETED)
+
+        if not chat_task.done():
+            chat_task.cancel()
+            try:
+                await chat_task
+            except (asyncio.CancelledError, ChatDeadlineExceeded):
+                pass
+            outcome = "cancelled"
+            print(f"🟡 Client disconnected, chat cancelled: {budget.report()}")
+            # 499 Client Closed Request; nobody is listening for the body
+            return Response(status_code=499)
+
+        response = chat_task.result()
+        outcome = "ok"
         add_assistant_message(messages, response)
 
+        # Other /chat requests may have finished while this one awaited the
+        # API, so append only this request's turns instead of replacing history
+        history.extend(messages[new_turns_start:])
+        messages = history
+
         # Extract text from content blocks for React frontend
-        response_text = ""
-        for block in response:
-            if hasattr(block, 'text'):
-                response_text += block.text
+        response_text = extract_text(response)
 
         return {"message": response_text, "messageHistory": messages}
+    except ChatDeadlineExceeded as e:
+        outcome = "deadline_exceeded"
+        print(f"🟡 Chat deadline exceeded: {budget.report()}")
+        raise HTTPException(
+            status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+            detail={
+                "error": "deadline_exceeded",
+                "partial": bool(e.partial_text),
+                "message": e.partial_text,
+                "usage": budget.report()
+            }
+        )
     except Exception as e:
         print(f"Error: {str(e)}")
         print(f"Traceback: {traceback.format_exc()}")
         raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
+    finally:
+        for task in (chat_task, disconnect_task):
+            if task and not task.done():
+                task.cancel()
+        if chat_task:
+            record_chat_usage(chat_request.user_id, outcome, budget)
 
 @app.post("/reset_conversation")
 async def reset_conversation():
@@ -297,9 +501,141 @@ async def reset_conversation():
 def get_users(db: Session = Depends(get_db)):
     users = db.query(models.User).all()
     # Convert to UserResponse format manually to exclude password
-    user_responses = [schemas.UserResponse.model_validate(user) for user in users]
+    with span("serialization"):
+        user_responses = [schemas.UserResponse.model_validate(user) for user in users]
     return {"data": user_responses}
 
+# Upper bound on the rows each search reads per column before ranking
+SEARCH_CANDIDATE_LIMIT = int(os.getenv("SEARCH_CANDIDATE_LIMIT", "500"))
+
+def escape_like(value: str) -> str:
+    """Escape LIKE wildcards so user input is matched literally"""
+    # Backslash is Postgres' default LIKE escape character
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+def search_candidates(column, mode, pattern, term):
+    """Ids of the best matches on one column, read in index order and capped"""
+    column_lower = func.lower(column)
+    if mode == "prefix":
+        # COLLATE "C" btree: matches come back alphabetically, exact match first
+        key = column_lower.collate("C")
+        query = select(models.User.id).where(key.like(pattern)).order_by(key)
+    else:
+        # GiST trigram index: nearest-neighbour scan by trigram distance
+        query = (
+            select(models.User.id)
+            .where(column_lower.like(pattern))
+            .order_by(column_lower.op("<->")(term))
+        )
+    return select(query.limit(SEARCH_CANDIDATE_LIMIT).subquery().c.id)
+
+def parse_search_cursor(cursor: str):
+    try:
+        rank, score, user_id = cursor.split(":")
+        return int(rank), float(score), int(user_id)
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="Invalid search cursor"
+        )
+
+@app.get("/users/search", status_code=status.HTTP_200_OK)
+def search_users(
+    q: str = Query(..., min_length=1, max_length=100),
+    mode: str = Query("substring", pattern="^(prefix|substring)$"),
+    cursor: Optional[str] = None,
+    page_size: int = Query(20, ge=1, le=100),
+    db: Session = Depends(get_db)
+):
+    """Ranked prefix/substring search over username and email.
+
+    At most SEARCH_CANDIDATE_LIMIT best matches per column are ranked and
+    paged through, so very common terms cannot be paged to the end. When a
+    column hits that cap the response has "truncated": true; narrow the query
+    to reach the rest.
+    """
+    term = q.strip().lower()
+    if not term:
+        # min_length is checked before stripping; an empty term would match every row
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="Search query must not be blank"
+        )
+    if mode == "substring" and len(term) < 3:
+        # Trigram indexes cannot serve substrings shorter than 3 characters
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail="Substring search requires at least 3 characters"
+        )
+
+    escaped = escape_like(term)
+    pattern = f"{escaped}%" if mode == "prefix" else f"%{escaped}%"
+
+    # Only rank a bounded candidate set: up to SEARCH_CANDIDATE_LIMIT rows per
+    # column, each read straight off its index, so common terms like "gmail"
+    # never sort the whole table
+    username_candidates = search_candidates(models.User.username, mode, pattern, term)
+    email_candidates = search_candidates(models.User.email, mode, pattern, term)
+    candidate_ids = union(username_candidates, email_candidates).subquery()
+
+    # A column that filled its cap may have more matches than can be paged to.
+    # Counting a capped subquery reads at most SEARCH_CANDIDATE_LIMIT index entries
+    truncated = any(
+        db.execute(select(func.count()).select_from(candidates.subquery())).scalar()
+        >= SEARCH_CANDIDATE_LIMIT
+        for candidates in (username_candidates, email_candidates)
+    )
+
+    username_lower = func.lower(models.User.username)
+    email_lower = func.lower(models.User.email)
+
+    # Rank exact matches first, then prefix matches, then by trigram similarity
+    match_rank = case(
+        (or_(username_lower == term, email_lower == term), 0),
+        (or_(username_lower.like(f"{escaped}%"), email_lower.like(f"{escaped}%")), 1),
+        else_=2,
+    )
+    similarity = func.greatest(
+        func.similarity(username_lower, term),
+        func.similarity(email_lower, term),
+    )
+
+    query = db.query(models.User, match_rank, similarity).filter(
+        models.User.id.in_(select(candidate_ids.c.id))
+    )
+    if cursor:
+        # Keyset pagination: continue after the last row of the previous page.
+        # similarity() is a real, so compare in real to avoid float8 rounding
+        last_rank, last_score, last_id = parse_search_cursor(cursor)
+        query = query.filter(
+            tuple_(match_rank, -similarity, models.User.id)
+            > tuple_(last_rank, cast(-last_score, REAL), last_id)
+        )
+
+    # Fetch one extra row to know if there is another page without a COUNT(*)
+    rows = (
+        query
+        .order_by(match_rank, similarity.desc(), models.User.id)
+        .limit(page_size + 1)
+        .all()
+    )
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+    next_cursor = None
+    if has_more:
+        last_user, last_rank, last_score = rows[-1]
+        next_cursor = f"{last_rank}:{last_score!r}:{last_user.id}"
+
+    with span("serialization"):
+        user_responses = [schemas.UserResponse.model_validate(user) for user, _, _ in rows]
+    return {
+        "data": user_responses,
+        "page_size": page_size,
+        "has_more": has_more,
+        "next_cursor": next_cursor,
+        "truncated": truncated
+    }
+
 @app.get("/users/{email}", status_code=status.HTTP_200_OK)
 def get_user_by_email(email: str, db: Session = Depends(get_db)):
     user = db.query(models.User).filter(models.User.email == email).first()
@@ -491,5 +827,101 @@ def update_user_by_email(email: str, user_update: schemas.UpdateUser, db: Sessio
         )
 
 
+# Token for admin-only endpoints (usage billing data, profiles), sent as
+# X-Admin-Token. Separate from PROFILE_ADMIN_TOKEN, which only turns profiling on.
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    if not tokens_match(x_admin_token, ADMIN_TOKEN):
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="This endpoint requires a valid X-Admin-Token"
+        )
+
+def usage_totals_columns():
+    return [
+        func.count(models.UsageRecord.id).label("requests"),
+        func.coalesce(func.sum(models.UsageRecord.input_tokens), 0).label("input_tokens"),
+        func.coalesce(func.sum(models.UsageRecord.output_tokens), 0).label("output_tokens"),
+        func.coalesce(func.sum(models.UsageRecord.cache_creation_input_tokens), 0).label("cache_creation_input_tokens"),
+        func.coalesce(func.sum(models.UsageRecord.cache_read_input_tokens), 0).label("cache_read_input_tokens"),
+        func.coalesce(func.sum(models.UsageRecord.tool_iterations), 0).label("tool_iterations"),
+        func.avg(models.UsageRecord.latency_ms).label("avg_latency_ms"),
+        func.max(models.UsageRecord.latency_ms).label("max_latency_ms"),
+    ]
+
+def usage_row_to_dict(row):
+    data = dict(row._mapping)
+    if data.get("avg_latency_ms") is not None:
+        data["avg_latency_ms"] = round(float(data["avg_latency_ms"]), 1)
+    return data
+
+def filter_usage_range(query, start: Optional[date], end: Optional[date]):
+    # end is inclusive: everything before the start of the following day
+    if start:
+        query = query.filter(models.UsageRecord.created_at >= start)
+    if end:
+        query = query.filter(models.UsageRecord.created_at < end + timedelta(days=1))
+    return query
+
+@app.get("/usage/stats", status_code=status.HTTP_200_OK, dependencies=[Depends(require_admin)])
+def get_usage_ledger_stats():
+    """Write-behind queue counters, including dropped and failed records"""
+    return {"data": usage_ledger.stats()}
+
+@app.get("/usage/users/{user_id}", status_code=status.HTTP_200_OK, dependencies=[Depends(require_admin)])
+def get_user_usage(
+    user_id: int,
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    db: Session = Depends(get_db)
+):
+    query = db.query(*usage_totals_columns()).filter(models.UsageRecord.user_id == user_id)
+    row = filter_usage_range(query, start, end).one()
+    return {"data": {"user_id": user_id, **usage_row_to_dict(row)}}
+
+@app.get("/usage/daily", status_code=status.HTTP_200_OK, dependencies=[Depends(require_admin)])
+def get_daily_usage(
+    user_id: Optional[int] = None,
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    db: Session = Depends(get_db)
+):
+    day = func.date_trunc("day", models.UsageRecord.created_at).label("day")
+    query = db.query(day, *usage_totals_columns())
+    if user_id is not None:
+        query = query.filter(models.UsageRecord.user_id == user_id)
+    rows = filter_usage_range(query, start, end).group_by(day).order_by(day).all()
+    return {"data": [usage_row_to_dict(row) for row in rows]}
+
+@app.get("/debug/profiles", status_code=status.HTTP_200_OK, dependencies=[Depends(require_admin)])
+def list_profiles():
+    """List the most recent request profiles, newest first"""
+    return {"data": [profile.summary() for profile in profile_store.list()]}
+
+def get_profile_or_404(profile_id: str):
+    profile = profile_store.get(profile_id)
+    if not profile:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Profile {profile_id} not found"
+        )
+    return profile
+
+@app.get("/debug/profiles/{profile_id}", status_code=status.HTTP_200_OK, dependencies=[Depends(require_admin)])
+def get_profile(profile_id: str):
+    """Span breakdown for a single profiled request"""
+    return {"data": get_profile_or_404(profile_id).to_dict()}
+
+@app.get("/debug/profiles/{profile_id}/flamegraph", dependencies=[Depends(require_admin)])
+def get_profile_flamegraph(profile_id: str):
+    """Sampled CPU stacks in collapsed format (flamegraph.pl, speedscope)"""
+    profile = get_profile_or_404(profile_id)
+    return PlainTextResponse(
+        profile.folded_stacks(),
+        headers={"Content-Disposition": f'attachment; filename="profile-{profile_id}.folded"'}
+    )
+
+
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=8000, reload=True)
\ No newline at end of file
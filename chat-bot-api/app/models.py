@@ -1,6 +1,6 @@
 
 from .database import Base
-from sqlalchemy import Column, Integer, String, Boolean, TIMESTAMP, text
+from sqlalchemy import Column, Integer, String, Boolean, TIMESTAMP, Index, func, text
 
 class User(Base):
     __tablename__ = "users"
@@ -14,3 +14,52 @@ class User(Base):
     created_at = Column(TIMESTAMP(timezone=True), nullable=False, server_default=text('now()'))
     updated_at = Column(TIMESTAMP(timezone=True), nullable=False, server_default=text('now()'))
 
+
+class UsageRecord(Base):
+    __tablename__ = "usage_ledger"
+
+    id = Column(Integer, primary_key=True, nullable=False)
+    # Not a foreign key: one unknown id must not fail a whole batched insert
+    user_id = Column(Integer, nullable=True)
+    model = Column(String, nullable=False)
+    status = Column(String, nullable=False)
+    input_tokens = Column(Integer, nullable=False, server_default='0')
+    output_tokens = Column(Integer, nullable=False, server_default='0')
+    cache_creation_input_tokens = Column(Integer, nullable=False, server_default='0')
+    cache_read_input_tokens = Column(Integer, nullable=False, server_default='0')
+    upstream_calls = Column(Integer, nullable=False, server_default='0')
+    tool_iterations = Column(Integer, nullable=False, server_default='0')
+    latency_ms = Column(Integer, nullable=False)
+    created_at = Column(TIMESTAMP(timezone=True), nullable=False, server_default=text('now()'))
+
+    __table_args__ = (
+        Index("ix_usage_ledger_user_id_created_at", "user_id", "created_at"),
+        Index("ix_usage_ledger_created_at", "created_at"),
+    )
+
+
+# Search indexes on lower(username) / lower(email):
+# - btree on COLLATE "C" serves prefix lookups (LIKE 'abc%') and returns
+#   them in index order, so a capped candidate scan needs no sort
+# - GiST trigram (pg_trgm) serves substring lookups (LIKE '%abc%') as a
+#   nearest-neighbour scan ordered by trigram distance (<->)
+Index(
+    "ix_users_username_lower_prefix",
+    func.lower(User.username).collate("C"),
+)
+Index(
+    "ix_users_email_lower_prefix",
+    func.lower(User.email).collate("C"),
+)
+Index(
+    "ix_users_username_lower_trgm",
+    func.lower(User.username).label("username_lower"),
+    postgresql_using="gist",
+    postgresql_ops={"username_lower": "gist_trgm_ops"},
+)
+Index(
+    "ix_users_email_lower_trgm",
+    func.lower(User.email).label("email_lower"),
+    postgresql_using="gist",
+    postgresql_ops={"email_lower": "gist_trgm_ops"},
+)
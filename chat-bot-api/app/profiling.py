@@ -0,0 +1,307 @@
+from collections import Counter, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from fastapi.routing import APIRoute
+from sqlalchemy import event
+import functools
+import hmac
+import inspect
+import os
+import random
+import sys
+import threading
+import time
+import uuid
+
+# Requests carrying X-Profile: <PROFILE_ADMIN_TOKEN> are always profiled,
+# otherwise a PROFILE_SAMPLE_RATE fraction (0.0 - 1.0) of requests is
+PROFILE_ADMIN_TOKEN = os.getenv("PROFILE_ADMIN_TOKEN")
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_SAMPLE_INTERVAL_MS = float(os.getenv("PROFILE_SAMPLE_INTERVAL_MS", "5"))
+PROFILE_BUFFER_SIZE = int(os.getenv("PROFILE_BUFFER_SIZE", "50"))
+
+# The profile of the request currently being handled, or None when profiling is off
+_current_profile = ContextVar("current_profile", default=None)
+
+
+class RequestProfile:
+    """Wall-clock spans and sampled stacks captured for a single request"""
+    def __init__(self, method, path):
+        self.id = uuid.uuid4().hex
+        self.method = method
+        self.path = path
+        self.created_at = datetime.now(timezone.utc)
+        self.started = time.perf_counter()
+        self.duration_ms = None
+        self.status_code = None
+        self.spans = []
+        self.samples = Counter()
+        # Threads currently doing work for this request (thread id -> nesting
+        # depth); only these are sampled, and only while the work is running
+        self.active_threads = Counter()
+        self._lock = threading.Lock()
+
+    def enter_thread(self, thread_id):
+        with self._lock:
+            self.active_threads[thread_id] += 1
+
+    def exit_thread(self, thread_id):
+        with self._lock:
+            self.active_threads[thread_id] -= 1
+            if self.active_threads[thread_id] <= 0:
+                del self.active_threads[thread_id]
+
+    def sampled_thread_ids(self):
+        with self._lock:
+            return list(self.active_threads)
+
+    def add_span(self, name, start, end):
+        with self._lock:
+            self.spans.append({
+                "name": name,
+                "start_ms": round((start - self.started) * 1000, 3),
+                "duration_ms": round((end - start) * 1000, 3),
+            })
+
+    def breakdown(self):
+        totals = {}
+        for s in self.spans:
+            entry = totals.setdefault(s["name"], {"count": 0, "total_ms": 0.0})
+            entry["count"] += 1
+            entry["total_ms"] = round(entry["total_ms"] + s["duration_ms"], 3)
+        return totals
+
+    def summary(self):
+        return {
+            "id": self.id,
+            "method": self.method,
+            "path": self.path,
+            "status_code": self.status_code,
+            "created_at": self.created_at,
+            "duration_ms": self.duration_ms,
+            "samples": sum(self.samples.values()),
+        }
+
+    def to_dict(self):
+        data = self.summary()
+        breakdown = self.breakdown()
+        data["breakdown"] = breakdown
+        if self.duration_ms is not None:
+            # Time not covered by any span: routing, validation, response encoding, ...
+            data["unaccounted_ms"] = round(
+                self.duration_ms - sum(entry["total_ms"] for entry in breakdown.values()), 3
+            )
+        data["spans"] = self.spans
+        return data
+
+    def folded_stacks(self):
+        """Samples in collapsed-stack format, as consumed by flamegraph.pl / speedscope
+
+        Event-loop samples are taken from a thread every in-flight async
+        request shares, so under concurrency they can include other requests'
+        coroutines; threadpool samples belong to this request only.
+        """
+        return "".join(f"{stack} {count}\n" for stack, count in self.samples.most_common())
+
+
+class ProfileStore:
+    """Bounded ring buffer of the most recent request profiles"""
+    def __init__(self, maxlen):
+        self._profiles = deque(maxlen=maxlen)
+        self._lock = threading.Lock()
+
+    def add(self, profile):
+        with self._lock:
+            self._profiles.append(profile)
+
+    def get(self, profile_id):
+        with self._lock:
+            for profile in self._profiles:
+                if profile.id == profile_id:
+                    return profile
+        return None
+
+    def list(self):
+        with self._lock:
+            return list(reversed(self._profiles))
+
+
+profile_store = ProfileStore(PROFILE_BUFFER_SIZE)
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+# Leaf frames of an event loop waiting for I/O (asyncio's selector loop, or
+# the Python caller of uvloop's C run loop). Samples ending here are idle time,
+# not CPU, and are dropped.
+IDLE_FRAMES = {
+    ("selectors.py", "select"),
+    ("base_events.py", "run_forever"),
+    ("base_events.py", "run_until_complete"),
+    ("runners.py", "run"),
+}
+
+
+def _is_idle(frame):
+    code = frame.f_code
+    return (os.path.basename(code.co_filename), code.co_name) in IDLE_FRAMES
+
+
+class StackSampler(threading.Thread):
+    """Periodically records the Python stacks of the threads working on a request
+
+    A threadpool worker is sampled only while it runs this request's endpoint
+    or spans, so work it picks up for other requests afterwards is excluded.
+    """
+    def __init__(self, profile, interval):
+        super().__init__(daemon=True)
+        self.profile = profile
+        self.interval = interval
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            frames = sys._current_frames()
+            for thread_id in self.profile.sampled_thread_ids():
+                frame = frames.get(thread_id)
+                if frame is None or _is_idle(frame):
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_label(frame))
+                    frame = frame.f_back
+                self.profile.samples[";".join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+@contextmanager
+def profiled_thread():
+    """Sample the calling thread for the current request while the block runs"""
+    profile = _current_profile.get()
+    if profile is None:
+        yield
+        return
+    thread_id = threading.get_ident()
+    profile.enter_thread(thread_id)
+    try:
+        yield
+    finally:
+        profile.exit_thread(thread_id)
+
+
+@contextmanager
+def span(name):
+    """Time a block of work as a named span of the current request's profile"""
+    profile = _current_profile.get()
+    if profile is None:
+        yield
+        return
+    start = time.perf_counter()
+    with profiled_thread():
+        try:
+            yield
+        finally:
+            profile.add_span(name, start, time.perf_counter())
+
+
+class ProfiledRoute(APIRoute):
+    """Route class that samples a sync endpoint's worker thread from its first line
+
+    FastAPI runs `def` endpoints in the threadpool; wrapping them registers the
+    worker as soon as the endpoint starts and unregisters it when it returns.
+    """
+    def __init__(self, path, endpoint, **kwargs):
+        if not inspect.iscoroutinefunction(endpoint):
+            endpoint = _profile_sync_endpoint(endpoint)
+        super().__init__(path, endpoint, **kwargs)
+
+
+def _profile_sync_endpoint(endpoint):
+    # functools.wraps keeps __wrapped__, which FastAPI follows to read the
+    # endpoint's parameters
+    @functools.wraps(endpoint)
+    def wrapper(*args, **kwargs):
+        with profiled_thread():
+            return endpoint(*args, **kwargs)
+    return wrapper
+
+
+def instrument_engine(engine):
+    """Record every SQL statement run on the engine as a db_query span"""
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if _current_profile.get() is not None:
+            conn.info.setdefault("profile_query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        profile = _current_profile.get()
+        starts = conn.info.get("profile_query_start")
+        if profile is not None and starts:
+            profile.add_span("db_query", starts.pop(), time.perf_counter())
+
+
+def tokens_match(token, expected):
+    """True if token equals the configured secret; never matches an unset secret"""
+    if not expected or not token:
+        return False
+    # Constant-time comparison so the token can't be guessed byte by byte
+    return hmac.compare_digest(token.encode(), expected.encode())
+
+
+class ProfilingMiddleware:
+    """ASGI middleware that profiles opted-in or sampled requests.
+
+    Written as plain ASGI rather than BaseHTTPMiddleware so it does not
+    wrap the receive channel that /chat uses to detect client disconnects.
+    """
+    def __init__(self, app):
+        self.app = app
+
+    def should_profile(self, scope):
+        # Don't fill the buffer with admin traffic: requests for the profiles
+        # themselves, or a dashboard polling the usage endpoints
+        if scope["type"] != "http" or scope["path"].startswith(("/debug/profiles", "/usage")):
+            return False
+        if PROFILE_ADMIN_TOKEN:
+            for key, value in scope["headers"]:
+                if key == b"x-profile":
+                    return tokens_match(value.decode("latin-1"), PROFILE_ADMIN_TOKEN)
+        return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+    async def __call__(self, scope, receive, send):
+        if not self.should_profile(scope):
+            await self.app(scope, receive, send)
+            return
+
+        profile = RequestProfile(scope["method"], scope["path"])
+        token = _current_profile.set(profile)
+        # Routing, validation and async endpoints run on the event loop thread
+        loop_thread_id = threading.get_ident()
+        profile.enter_thread(loop_thread_id)
+        sampler = StackSampler(profile, PROFILE_SAMPLE_INTERVAL_MS / 1000)
+        sampler.start()
+
+        async def send_with_profile_id(message):
+            if message["type"] == "http.response.start":
+                profile.status_code = message["status"]
+                headers = list(message.get("headers", []))
+                headers.append((b"x-profile-id", profile.id.encode()))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_profile_id)
+        finally:
+            profile.exit_thread(loop_thread_id)
+            sampler.stop()
+            profile.duration_ms = round((time.perf_counter() - profile.started) * 1000, 3)
+            _current_profile.reset(token)
+            profile_store.add(profile)
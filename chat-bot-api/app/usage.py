@@ -0,0 +1,135 @@
+from datetime import datetime, timezone
+from sqlalchemy import insert
+from . import models
+from .database import SessionLocal
+import asyncio
+import os
+import traceback
+
+# Write-behind settings for the usage ledger
+USAGE_QUEUE_SIZE = int(os.getenv("USAGE_QUEUE_SIZE", "10000"))
+USAGE_BATCH_SIZE = int(os.getenv("USAGE_BATCH_SIZE", "500"))
+USAGE_FLUSH_INTERVAL_SECONDS = float(os.getenv("USAGE_FLUSH_INTERVAL_SECONDS", "2"))
+# A failed batch is retried this many times, backing off from USAGE_RETRY_BACKOFF_SECONDS
+USAGE_FLUSH_RETRIES = int(os.getenv("USAGE_FLUSH_RETRIES", "3"))
+USAGE_RETRY_BACKOFF_SECONDS = float(os.getenv("USAGE_RETRY_BACKOFF_SECONDS", "0.5"))
+
+
+class UsageLedger:
+    """Buffers usage records in memory and writes them to usage_ledger in batches.
+
+    record() never blocks the request: when the queue is full the record is
+    dropped and counted instead. A background task drains the queue and
+    inserts each batch as a single multi-row INSERT, retrying with
+    exponential backoff so a short database outage doesn't lose records.
+    """
+    def __init__(self, maxsize, batch_size, flush_interval, max_retries, retry_backoff):
+        self.maxsize = maxsize
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.queue = None
+        self.task = None
+        self.stopping = None
+        self.enqueued = 0
+        self.flushed = 0
+        self.dropped = 0
+        self.failed = 0
+        self.retries = 0
+        self.batches = 0
+
+    def record(self, **fields):
+        # Nothing would flush a record queued before start() or after stop()
+        if self.queue is None or self.stopping.is_set():
+            self.dropped += 1
+            return
+        fields.setdefault("created_at", datetime.now(timezone.utc))
+        try:
+            self.queue.put_nowait(fields)
+            self.enqueued += 1
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    def start(self):
+        self.queue = asyncio.Queue(maxsize=self.maxsize)
+        self.stopping = asyncio.Event()
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        """Stop the background task once whatever is still queued has been flushed"""
+        if self.task:
+            self.stopping.set()
+            await self.task
+            self.task = None
+
+    def drain(self):
+        batch = []
+        while len(batch) < self.batch_size and not self.queue.empty():
+            batch.append(self.queue.get_nowait())
+        return batch
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.stopping.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            # Always drain before checking for shutdown, so records queued
+            # before stop() are flushed even if it lands before the first pass
+            while not self.queue.empty():
+                await self.flush(self.drain())
+            if self.stopping.is_set():
+                break
+
+    async def flush(self, batch):
+        for attempt in range(self.max_retries + 1):
+            try:
+                # The insert is blocking, keep it off the event loop
+                await asyncio.to_thread(write_batch, batch)
+                self.flushed += len(batch)
+                self.batches += 1
+                return
+            except Exception as e:
+                if attempt == self.max_retries:
+                    self.failed += len(batch)
+                    print(f"🔴 Usage ledger flush failed, {len(batch)} records lost: {str(e)}")
+                    print(f"Traceback: {traceback.format_exc()}")
+                    return
+                delay = self.retry_backoff * 2 ** attempt
+                self.retries += 1
+                print(f"🟡 Usage ledger flush failed, retrying in {delay}s: {str(e)}")
+                await asyncio.sleep(delay)
+
+    def stats(self):
+        return {
+            "queued": self.queue.qsize() if self.queue else 0,
+            "capacity": self.maxsize,
+            "enqueued": self.enqueued,
+            "flushed": self.flushed,
+            "dropped": self.dropped,
+            "failed": self.failed,
+            "retries": self.retries,
+            "batches": self.batches,
+        }
+
+
+def write_batch(batch):
+    db = SessionLocal()
+    try:
+        db.execute(insert(models.UsageRecord).values(batch))
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        db.close()
+
+
+usage_ledger = UsageLedger(
+    USAGE_QUEUE_SIZE,
+    USAGE_BATCH_SIZE,
+    USAGE_FLUSH_INTERVAL_SECONDS,
+    USAGE_FLUSH_RETRIES,
+    USAGE_RETRY_BACKOFF_SECONDS,
+)
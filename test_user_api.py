@@ -6,8 +6,11 @@ Run this after the API server is running.
 
 import requests
 import json
+import os
 
 BASE_URL = "http://localhost:8000"
+# Admin token for the /usage endpoints (same value as the server's ADMIN_TOKEN)
+ADMIN_HEADERS = {"X-Admin-Token": os.getenv("ADMIN_TOKEN", "")}
 
 def test_create_user():
     """Test creating a new user"""
@@ -106,6 +109,163 @@ def test_get_user_by_email():
     except requests.exceptions.RequestException as e:
         print(f"❌ Request failed: {e}")
 
+def test_search_users():
+    """Test searching users by username/email prefix and substring"""
+    print("\nTesting user search...")
+    
+    try:
+        # Prefix search
+        response = requests.get(f"{BASE_URL}/users/search", params={"q": "john", "mode": "prefix"})
+        print(f"Prefix search - Status Code: {response.status_code}")
+        
+        if response.status_code == 200:
+            users = response.json()["data"]
+            print(f"✅ Prefix search found {len(users)} users")
+            for user in users[:3]:
+                print(f"  - {user['username']} ({user['email']})")
+        else:
+            print("❌ Prefix search failed")
+        
+        # Substring search with cursor pagination
+        params = {"q": "example", "mode": "substring", "page_size": 5}
+        response = requests.get(f"{BASE_URL}/users/search", params=params)
+        print(f"Substring search - Status Code: {response.status_code}")
+        
+        if response.status_code == 200:
+            body = response.json()
+            print(f"✅ Substring search found {len(body['data'])} users "
+                  f"(has_more={body['has_more']}, truncated={body['truncated']})")
+            if body["next_cursor"]:
+                response = requests.get(
+                    f"{BASE_URL}/users/search",
+                    params={**params, "cursor": body["next_cursor"]}
+                )
+                next_ids = {user["id"] for user in response.json()["data"]}
+                first_ids = {user["id"] for user in body["data"]}
+                if response.status_code == 200 and not next_ids & first_ids:
+                    print(f"✅ Next page returned {len(next_ids)} different users")
+                else:
+                    print("❌ Next page overlaps the first page")
+        else:
+            print("❌ Substring search failed")
+        
+        # Blank queries are rejected instead of matching everything
+        response = requests.get(f"{BASE_URL}/users/search", params={"q": "   ", "mode": "prefix"})
+        if response.status_code == 422:
+            print("✅ Blank query correctly rejected")
+        
+        # Substring search needs at least 3 characters
+        response = requests.get(f"{BASE_URL}/users/search", params={"q": "jo", "mode": "substring"})
+        if response.status_code == 422:
+            print("✅ Short substring query correctly rejected")
+            
+    except requests.exceptions.RequestException as e:
+        print(f"❌ Request failed: {e}")
+
+def test_chat_timeout_validation():
+    """Test that an invalid X-Request-Timeout header is rejected before any chat work"""
+    print("\nTesting chat timeout header validation...")
+    
+    try:
+        for timeout in ["abc", "0", "-5"]:
+            response = requests.post(
+                f"{BASE_URL}/chat",
+                json={"message": "What time is it?"},
+                headers={"X-Request-Timeout": timeout}
+            )
+            print(f"X-Request-Timeout={timeout!r} - Status Code: {response.status_code}")
+            
+            if response.status_code == 400:
+                print(f"✅ Invalid timeout correctly rejected: {response.json()['detail']}")
+            else:
+                print("❌ Expected 400 Bad Request")
+            
+    except requests.exceptions.RequestException as e:
+        print(f"❌ Request failed: {e}")
+
+def test_usage_stats():
+    """Test the usage ledger queue counters (admin only)"""
+    print("\nTesting usage ledger stats...")
+    
+    try:
+        response = requests.get(f"{BASE_URL}/usage/stats")
+        if response.status_code == 403:
+            print("✅ Usage stats correctly require the admin token")
+        else:
+            print(f"❌ Expected 403 without admin token, got {response.status_code}")
+        
+        response = requests.get(f"{BASE_URL}/usage/stats", headers=ADMIN_HEADERS)
+        print(f"Status Code: {response.status_code}")
+        
+        if response.status_code == 200:
+            stats = response.json()["data"]
+            print(f"✅ Ledger stats: {stats['flushed']} flushed, {stats['queued']} queued, "
+                  f"{stats['dropped']} dropped, {stats['failed']} failed, {stats['retries']} retries")
+        elif response.status_code == 403:
+            print("⚠️  Set ADMIN_TOKEN to run the usage tests")
+        else:
+            print("❌ Failed to get usage stats")
+            
+    except requests.exceptions.RequestException as e:
+        print(f"❌ Request failed: {e}")
+
+def test_usage_user():
+    """Test per-user usage totals (admin only)"""
+    print("\nTesting per-user usage totals...")
+    
+    try:
+        response = requests.get(f"{BASE_URL}/usage/users/1")
+        if response.status_code == 403:
+            print("✅ Per-user usage correctly requires the admin token")
+        else:
+            print(f"❌ Expected 403 without admin token, got {response.status_code}")
+        
+        response = requests.get(
+            f"{BASE_URL}/usage/users/1",
+            params={"start": "2024-01-01"},
+            headers=ADMIN_HEADERS
+        )
+        print(f"Status Code: {response.status_code}")
+        
+        if response.status_code == 200:
+            usage = response.json()["data"]
+            print(f"✅ User {usage['user_id']}: {usage['requests']} requests, "
+                  f"{usage['input_tokens']} input / {usage['output_tokens']} output tokens")
+        elif response.status_code == 403:
+            print("⚠️  Set ADMIN_TOKEN to run the usage tests")
+        else:
+            print("❌ Failed to get per-user usage")
+            
+    except requests.exceptions.RequestException as e:
+        print(f"❌ Request failed: {e}")
+
+def test_usage_daily():
+    """Test per-day usage totals (admin only)"""
+    print("\nTesting daily usage totals...")
+    
+    try:
+        response = requests.get(f"{BASE_URL}/usage/daily")
+        if response.status_code == 403:
+            print("✅ Daily usage correctly requires the admin token")
+        else:
+            print(f"❌ Expected 403 without admin token, got {response.status_code}")
+        
+        response = requests.get(f"{BASE_URL}/usage/daily", headers=ADMIN_HEADERS)
+        print(f"Status Code: {response.status_code}")
+        
+        if response.status_code == 200:
+            days = response.json()["data"]
+            print(f"✅ Found usage for {len(days)} days")
+            for day in days[-3:]:  # Show the 3 most recent days
+                print(f"  - {day['day']}: {day['requests']} requests, avg {day['avg_latency_ms']} ms")
+        elif response.status_code == 403:
+            print("⚠️  Set ADMIN_TOKEN to run the usage tests")
+        else:
+            print("❌ Failed to get daily usage")
+            
+    except requests.exceptions.RequestException as e:
+        print(f"❌ Request failed: {e}")
+
 if __name__ == "__main__":
     print("🚀 Testing User API Endpoints")
     print("=" * 40)
@@ -114,6 +274,11 @@ if __name__ == "__main__":
     test_duplicate_user()
     test_get_users()
     test_get_user_by_email()
+    test_search_users()
+    test_chat_timeout_validation()
+    test_usage_stats()
+    test_usage_user()
+    test_usage_daily()
     
     test_update_user()
     